@@ -1,4 +1,6 @@
-from typing import Dict, List, Tuple, Iterable, Any
+import math
+import warnings
+from typing import Dict, List, Tuple, Iterable, Any, Optional
 
 import numpy
 import torch
@@ -6,6 +8,7 @@ import torch.nn.functional as F
 from allennlp.data import TextFieldTensors, Vocabulary
 from allennlp.models.model import Model
 from allennlp.modules import Attention
+from allennlp.modules.attention import AdditiveAttention, DotProductAttention
 from allennlp.modules.token_embedders import Embedding
 from allennlp.nn import util
 from allennlp.nn.beam_search import BeamSearch
@@ -42,9 +45,9 @@ class MachampSeq2SeqDecoder(Model):
     beam_size : `int`, optional (default = `None`)
         Width of the beam for beam search. If not specified, greedy decoding is used.
     scheduled_sampling_ratio : `float`, optional (default = `0.`)
-        At each timestep during training, we sample a random number between 0 and 1, and if it is
-        not less than this value, we use the ground truth labels for the whole batch. Else, we use
-        the predictions from the previous time step for the whole batch. If this value is 0.0
+        For each token during training, we sample a random number between 0 and 1, and if it is
+        not less than this value, we use the ground truth label as the decoder input. Else, we use
+        the prediction from the previous time step. If this value is 0.0
         (default), this corresponds to teacher forcing, and if it is 1.0, it corresponds to not
         using target side ground truth labels.  See the following paper for more information:
         [Scheduled Sampling for Sequence Prediction with Recurrent Neural Networks. Bengio et al.,
@@ -53,6 +56,10 @@ class MachampSeq2SeqDecoder(Model):
         If True, the BLEU metric will be calculated during validation.
     ngram_weights : `Iterable[float]`, optional (default = `(0.25, 0.25, 0.25, 0.25)`)
         Weights to assign to scores for each ngram size.
+    tie_target_embeddings : `bool`, optional (default = `False`)
+        If True, the output projection shares its weights with the target embedder. If the
+        target embedding dimension differs from the decoder output dimension, the decoder output
+        is first projected to the target embedding dimension.
     """
 
     def __init__(
@@ -70,6 +77,7 @@ class MachampSeq2SeqDecoder(Model):
         bleu_ngram_weights: Iterable[float] = (0.25, 0.25, 0.25, 0.25),
         dataset_embeds_dim: int = 0,
         target_decoder_layers: int = 1,
+        tie_target_embeddings: bool = False,
         **kwargs,
     ) -> None:
 
@@ -87,10 +95,16 @@ class MachampSeq2SeqDecoder(Model):
         # TODO: don't use hardcoded indices
         self._start_index = 2   # self.vocab.get_token_index('[CLS]', self._target_namespace)
         self._end_index = 3     # self.vocab.get_token_index('[SEP]', self._target_namespace)
+        # Kept as a (non-persistent) buffer so it lives on the model's device, the initial
+        # predictions are then just an expanded view of it.
+        self.register_buffer(
+            "_start_token", torch.tensor(self._start_index, dtype=torch.long), persistent=False
+        )
 
         pad_index = self.vocab.get_token_index(
             self.vocab._padding_token, self._target_namespace
         )
+        self._pad_index = pad_index
 
         if use_bleu:
             self._bleu = BLEU(
@@ -99,6 +113,9 @@ class MachampSeq2SeqDecoder(Model):
         else:
             self._bleu = None
         self.metrics = {"bleu": self._bleu}
+        # Whether the metrics were updated since the last reset, the trainer asks for them after
+        # every batch, also during training when they are never updated.
+        self._metrics_updated = False
 
         # At prediction time, we use a beam search to find the most likely sequence of target tokens.
         beam_size = beam_size or 1
@@ -108,9 +125,16 @@ class MachampSeq2SeqDecoder(Model):
         )
 
         num_classes = self.vocab.get_vocab_size(namespace=self._target_namespace)
+        # The loss is normalized by the entropy of a uniform distribution over the target vocab.
+        self._inv_log_num_classes = 1.0 / math.log(num_classes)
+        # Index to token lookup for the target namespace, as a list to make lookups cheap.
+        index_to_token = self.vocab.get_index_to_token_vocabulary(self._target_namespace)
+        self._index_to_token: List[str] = [index_to_token[i] for i in range(num_classes)]
 
         # Attention mechanism applied to the encoder output for each step.
         self._attention = attention
+        # State entries that are computed once from the encoder and don't change while decoding.
+        self._encoder_state_keys = {"encoder_outputs", "source_mask", "encoder_outputs_projected"}
 
         # The input to the decoder is just the previous target embedding.
         target_embedding_dim = target_embedding_dim or self._encoder_output_dim
@@ -145,7 +169,18 @@ class MachampSeq2SeqDecoder(Model):
             self._decoder_cell = LSTMCell(self._decoder_input_dim, self._decoder_output_dim)
         # We project the hidden state from the decoder into the output vocabulary space
         # in order to get log probabilities of each target token, at each time step.
-        self._output_projection_layer = Linear(self._decoder_output_dim, num_classes)
+        self._embedding_projection_layer = None
+        if tie_target_embeddings:
+            # The output projection reuses the target embeddings, so its input has to live in
+            # the target embedding space.
+            if target_embedding_dim != self._decoder_output_dim:
+                self._embedding_projection_layer = Linear(
+                    self._decoder_output_dim, target_embedding_dim, bias=False
+                )
+            self._output_projection_layer = Linear(target_embedding_dim, num_classes)
+            self._output_projection_layer.weight = self._target_embedder.weight
+        else:
+            self._output_projection_layer = Linear(self._decoder_output_dim, num_classes)
 
     @overrides
     def forward(
@@ -174,6 +209,7 @@ class MachampSeq2SeqDecoder(Model):
                 # shape: (batch_size, max_predicted_sequence_length)
                 best_predictions = top_k_predictions[:, 0, :]
                 self._bleu(best_predictions, target_tokens["tokens"]["tokens"])
+                self._metrics_updated = True
 
         return output_dict
 
@@ -190,23 +226,24 @@ class MachampSeq2SeqDecoder(Model):
         predicted_indices = output_dict#["predictions"]
         if not isinstance(predicted_indices, numpy.ndarray):
             predicted_indices = predicted_indices.detach().cpu().numpy()
-        all_predicted_tokens = []
-        for top_k_predictions in predicted_indices:
-            # Beam search gives us the top k results for each source sentence in the batch
-            # we want top-k results.
-            if len(top_k_predictions.shape) == 1:
-                top_k_predictions = [top_k_predictions]
+        # Beam search gives us the top k results for each source sentence in the batch, greedy
+        # decoding only a single one.
+        # shape: (batch_size, beam_size, num_decoding_steps)
+        if predicted_indices.ndim == 2:
+            predicted_indices = predicted_indices[:, numpy.newaxis, :]
+
+        # Find the position of the first end symbol for all sequences at once, sequences
+        # without one are kept in full.
+        is_end = predicted_indices == self._end_index
+        # shape: (batch_size, beam_size)
+        lengths = numpy.where(is_end.any(-1), is_end.argmax(-1), predicted_indices.shape[-1])
 
+        all_predicted_tokens = []
+        for top_k_predictions, top_k_lengths in zip(predicted_indices.tolist(), lengths.tolist()):
             batch_predicted_tokens = []
-            for indices in top_k_predictions:
-                indices = list(indices)
+            for indices, length in zip(top_k_predictions, top_k_lengths):
                 # Collect indices till the first end_symbol
-                if self._end_index in indices:
-                    indices = indices[: indices.index(self._end_index)]
-                predicted_tokens = [
-                    self.vocab.get_token_from_index(x, namespace=self._target_namespace)
-                    for x in indices
-                ]
+                predicted_tokens = [self._index_to_token[x] for x in indices[:length]]
                 batch_predicted_tokens.append(predicted_tokens)
 
             all_predicted_tokens.append(batch_predicted_tokens)
@@ -256,12 +293,14 @@ class MachampSeq2SeqDecoder(Model):
         final_encoder_output = util.get_final_encoder_states(
             state["encoder_outputs"], state["source_mask"], bidirectional=False
         )
-        # Initialize the decoder hidden state with the final output of the encoder.
+        # Initialize the decoder hidden state with the final output of the encoder. The decoder
+        # runs in float32 (see the autocast in `_prepare_output_projections()`), so we cast its
+        # state once here rather than at every step.
         # shape: (batch_size, decoder_output_dim)
-        state["decoder_hidden"] = final_encoder_output
+        state["decoder_hidden"] = final_encoder_output.float()
         # shape: (batch_size, decoder_output_dim)
         state["decoder_context"] = state["encoder_outputs"].new_zeros(
-            batch_size, self._decoder_output_dim
+            batch_size, self._decoder_output_dim, dtype=torch.float
         )
         if self._target_decoder_layers > 1:
             # shape: (num_layers, batch_size, decoder_output_dim)
@@ -274,6 +313,15 @@ class MachampSeq2SeqDecoder(Model):
                 state["decoder_context"].unsqueeze(0).repeat(self._target_decoder_layers, 1, 1)
             )
 
+        if type(self._attention) is AdditiveAttention:
+            # The encoder side of additive attention is the same at every decoding step, so we
+            # project it once here instead of in every call to the attention. This relies on
+            # the internals of `AdditiveAttention`, so subclasses are left alone.
+            # shape: (batch_size, max_input_sequence_length, decoder_output_dim)
+            state["encoder_outputs_projected"] = state["encoder_outputs"].matmul(
+                self._attention._u_matrix
+            )
+
         return state
 
     def _forward_loop(
@@ -303,73 +351,201 @@ class MachampSeq2SeqDecoder(Model):
         else:
             num_decoding_steps = self._max_decoding_steps
 
-        # Initialize target predictions with the start index.
-        # shape: (batch_size,)
-        last_predictions = source_mask.new_full(
-            (batch_size,), fill_value=self._start_index, dtype=torch.long
+        # Without scheduled sampling the decoder inputs are known in advance, so we embed all of
+        # them with a single lookup instead of one per timestep.
+        teacher_forcing = bool(target_tokens) and not (
+            self.training and self._scheduled_sampling_ratio > 0.0
         )
+        if teacher_forcing:
+            # shape: (batch_size, num_decoding_steps, target_embedding_dim)
+            embedded_targets = self._target_embedder(targets[:, :num_decoding_steps])
+        elif target_tokens:
+            # Scheduled sampling: decide up front for every token whether the gold token or the
+            # previous prediction is fed to the decoder, so the loop doesn't sample on the host.
+            # shape: (batch_size, num_decoding_steps)
+            use_predictions = (
+                torch.rand(batch_size, num_decoding_steps, device=targets.device)
+                < self._scheduled_sampling_ratio
+            )
 
-        step_logits: List[torch.Tensor] = []
-        step_predictions: List[torch.Tensor] = []
+        if teacher_forcing and not self._attention:
+            # Without attention the decoder input at each step doesn't depend on the previous
+            # decoder state, so the whole target sequence can go through the LSTM at once.
+            # shape: (batch_size, num_decoding_steps, num_classes)
+            logits = self._forward_teacher_forced(embedded_targets, state)
 
-        for timestep in range(num_decoding_steps):
-            if self.training and torch.rand(1).item() < self._scheduled_sampling_ratio:
-                # Use gold tokens at test time and at a rate of 1 - _scheduled_sampling_ratio
-                # during training.
-                # shape: (batch_size,)
-                input_choices = last_predictions
-            elif not target_tokens:
-                # shape: (batch_size,)
-                input_choices = last_predictions
-            else:
+            # shape: (batch_size, num_decoding_steps)
+            predictions = logits.argmax(-1)
+        else:
+            # Initialize target predictions with the start index.
+            # shape: (batch_size,)
+            last_predictions = self._start_token.expand(batch_size)
+
+            # The per-step outputs are written into preallocated buffers rather than collected
+            # and concatenated. The logits buffer is allocated after the first step, so that it
+            # gets the dtype of the output projection (which differs under AMP). When gradients
+            # are needed the logits are stacked instead: every in-place write into the buffer
+            # would copy the full (batch_size, num_decoding_steps, num_classes) gradient during
+            # the backward pass.
+            preallocate_logits = not torch.is_grad_enabled()
+            step_logits: Optional[torch.Tensor] = None
+            step_logits_list: List[torch.Tensor] = []
+            # shape: (batch_size, num_decoding_steps)
+            step_predictions = source_mask.new_empty(
+                (batch_size, num_decoding_steps), dtype=torch.long
+            )
+            if not target_tokens:
                 # shape: (batch_size,)
-                input_choices = targets[:, timestep]
-
-            # shape: (batch_size, num_classes)
-            output_projections, state = self._prepare_output_projections(input_choices, state)
-
-            # list of tensors, shape: (batch_size, 1, num_classes)
-            step_logits.append(output_projections.unsqueeze(1))
-
-            # shape: (batch_size, num_classes)
-            class_probabilities = F.softmax(output_projections, dim=-1)
-
-            # shape (predicted_classes): (batch_size,)
-            _, predicted_classes = torch.max(class_probabilities, 1)
-
-            # shape (predicted_classes): (batch_size,)
-            last_predictions = predicted_classes
-
-            step_predictions.append(last_predictions.unsqueeze(1))
-
-        # shape: (batch_size, num_decoding_steps)
-        predictions = torch.cat(step_predictions, 1)
+                finished = source_mask.new_zeros((batch_size,), dtype=torch.bool)
+
+            for timestep in range(num_decoding_steps):
+                if not target_tokens:
+                    # shape: (batch_size,)
+                    input_choices = last_predictions
+                elif not teacher_forcing:
+                    # Use gold tokens at test time and at a rate of 1 - _scheduled_sampling_ratio
+                    # during training.
+                    # shape: (batch_size,)
+                    input_choices = torch.where(
+                        use_predictions[:, timestep], last_predictions, targets[:, timestep]
+                    )
+                else:
+                    # shape: (batch_size,)
+                    input_choices = targets[:, timestep]
+
+                # shape: (batch_size, num_classes)
+                if teacher_forcing:
+                    output_projections, state = self._prepare_output_projections(
+                        input_choices, state, embedded_input=embedded_targets[:, timestep]
+                    )
+                else:
+                    output_projections, state = self._prepare_output_projections(
+                        input_choices, state
+                    )
+
+                if preallocate_logits:
+                    if step_logits is None:
+                        # shape: (batch_size, num_decoding_steps, num_classes)
+                        step_logits = output_projections.new_empty(
+                            (batch_size, num_decoding_steps, output_projections.size(-1))
+                        )
+                    step_logits[:, timestep] = output_projections
+                else:
+                    step_logits_list.append(output_projections)
+
+                # The softmax is monotonic, so the most likely class is the argmax of the logits.
+                # shape (last_predictions): (batch_size,)
+                last_predictions = output_projections.argmax(-1)
+
+                step_predictions[:, timestep] = last_predictions
+
+                if not target_tokens:
+                    # Stop greedy decoding once every sequence produced an end symbol, and pad
+                    # the remaining steps with it so the predictions keep their shape.
+                    finished |= last_predictions == self._end_index
+                    if finished.all():
+                        step_predictions[:, timestep + 1 :] = self._end_index
+                        if preallocate_logits:
+                            # Don't hand out the never written logits of the skipped steps.
+                            step_logits = step_logits[:, : timestep + 1]
+                        break
+
+            predictions = step_predictions
+            # shape: (batch_size, num_decoding_steps, num_classes)
+            logits = step_logits if preallocate_logits else torch.stack(step_logits_list, 1)
 
         output_dict = {"predictions": predictions, "class_probabilities": predictions}
 
         if target_tokens:
-            # shape: (batch_size, num_decoding_steps, num_classes)
-            logits = torch.cat(step_logits, 1)
-
             # Compute loss.
-            target_mask = util.get_text_field_mask(target_tokens)
-            loss = self._get_loss(logits, targets, target_mask) * self.loss_weight
-            output_dict["loss"] = loss
-            output_dict['loss'] /= torch.log(torch.tensor(logits.shape[-1]))
+            loss = self._get_loss(logits, targets) * self.loss_weight
+            output_dict["loss"] = loss * self._inv_log_num_classes
 
         return output_dict
 
+    def _forward_teacher_forced(
+        self, embedded_targets: torch.Tensor, state: Dict[str, torch.Tensor]
+    ) -> torch.Tensor:
+        """
+        Decode the full (gold) target sequence with a single LSTM call instead of stepping
+        through it. Only valid without attention, and when the inputs are the gold tokens.
+        Returns the logits of shape (batch_size, num_decoding_steps, num_classes).
+        """
+        # shape: (num_decoding_steps, batch_size, target_embedding_dim)
+        decoder_input = embedded_targets.transpose(0, 1).float()
+
+        # Autocast is disabled for the LSTM, as in `_prepare_output_projections()`.
+        with torch.cuda.amp.autocast(False):
+            if self._target_decoder_layers > 1:
+                # shape: (num_decoding_steps, batch_size, decoder_output_dim)
+                decoder_outputs, _ = self._decoder_cell(
+                    decoder_input,
+                    (state["decoder_hidden"], state["decoder_context"]),
+                )
+            else:
+                # An LSTMCell holds the same parameters as a single layer LSTM, so we can
+                # feed them to the fused sequence kernel directly. They are separate tensors
+                # though, so on GPU cuDNN copies them into one flat buffer on every call (and
+                # warns about it). That copy is small next to the stepwise loop it replaces.
+                with warnings.catch_warnings():
+                    warnings.filterwarnings(
+                        "ignore", message="RNN module weights are not part of single contiguous"
+                    )
+                    # shape: (num_decoding_steps, batch_size, decoder_output_dim)
+                    decoder_outputs, _, _ = torch.lstm(
+                        decoder_input,
+                        (
+                            state["decoder_hidden"].unsqueeze(0),
+                            state["decoder_context"].unsqueeze(0),
+                        ),
+                        [
+                            self._decoder_cell.weight_ih,
+                            self._decoder_cell.weight_hh,
+                            self._decoder_cell.bias_ih,
+                            self._decoder_cell.bias_hh,
+                        ],
+                        True,  # has_biases
+                        1,  # num_layers
+                        0.0,  # dropout
+                        self.training,
+                        False,  # bidirectional
+                        False,  # batch_first
+                    )
+
+        # shape: (batch_size, num_decoding_steps, num_classes)
+        return self._project_output(decoder_outputs.transpose(0, 1))
+
     def _forward_beam_search(self, state: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
         """Make forward pass during prediction using a beam search."""
         batch_size = state["source_mask"].size()[0]
-        start_predictions = state["source_mask"].new_full(
-            (batch_size,), fill_value=self._start_index, dtype=torch.long
-        )
+        # shape: (batch_size,)
+        start_predictions = self._start_token.expand(batch_size)
+
+        # Beam search expands every state tensor to (batch_size * beam_size, *) and reorders it
+        # at each step. The encoder side is the same for all beams of a sentence, so we keep it
+        # out of the beam search state at batch size, and let the attention broadcast it over
+        # the beams instead.
+        encoder_state = {
+            key: tensor for key, tensor in state.items() if key in self._encoder_state_keys
+        }
+        decoder_state = {
+            key: tensor for key, tensor in state.items() if key not in self._encoder_state_keys
+        }
+
+        def take_step(
+            last_predictions: torch.Tensor, beam_state: Dict[str, torch.Tensor], step: int
+        ) -> Tuple[torch.Tensor, Dict[str, torch.Tensor]]:
+            class_log_probabilities, beam_state = self.take_step(
+                last_predictions, {**beam_state, **encoder_state}, step
+            )
+            for key in encoder_state:
+                del beam_state[key]
+            return class_log_probabilities, beam_state
 
         # shape (all_top_k_predictions): (batch_size, beam_size, num_decoding_steps)
         # shape (log_probabilities): (batch_size, beam_size)
         all_top_k_predictions, log_probabilities = self._beam_search.search(
-            start_predictions, state, self.take_step
+            start_predictions, decoder_state, take_step
         )
 
         output_dict = {
@@ -379,13 +555,17 @@ class MachampSeq2SeqDecoder(Model):
         return output_dict
 
     def _prepare_output_projections(
-        self, last_predictions: torch.Tensor, state: Dict[str, torch.Tensor]
+        self,
+        last_predictions: torch.Tensor,
+        state: Dict[str, torch.Tensor],
+        embedded_input: torch.Tensor = None,
     ) -> Tuple[torch.Tensor, Dict[str, torch.Tensor]]:
         """
         Decode current state and last prediction to produce produce projections
         into the target space, which can then be used to get probabilities of
         each target token for the next step.
-        Inputs are the same as for `take_step()`.
+        Inputs are the same as for `take_step()`. If `embedded_input` is given, it is
+        used as the embedding of `last_predictions` instead of looking it up again.
         """
         # shape: (group_size, max_input_sequence_length, encoder_output_dim)
         encoder_outputs = state["encoder_outputs"]
@@ -399,18 +579,25 @@ class MachampSeq2SeqDecoder(Model):
         # shape: (num_layers, group_size, decoder_output_dim)
         decoder_context = state["decoder_context"]
 
-        # shape: (group_size, target_embedding_dim)
-        embedded_input = self._target_embedder(last_predictions)
+        if embedded_input is None:
+            # shape: (group_size, target_embedding_dim)
+            embedded_input = self._target_embedder(last_predictions)
 
         if self._attention:
             # shape: (group_size, encoder_output_dim)
             if self._target_decoder_layers > 1:
                 attended_input = self._prepare_attended_input(
-                    decoder_hidden[0], encoder_outputs, source_mask
+                    decoder_hidden[0],
+                    encoder_outputs,
+                    source_mask,
+                    state.get("encoder_outputs_projected"),
                 )
             else:
                 attended_input = self._prepare_attended_input(
-                    decoder_hidden, encoder_outputs, source_mask
+                    decoder_hidden,
+                    encoder_outputs,
+                    source_mask,
+                    state.get("encoder_outputs_projected"),
                 )
             # shape: (group_size, decoder_output_dim + target_embedding_dim)
             decoder_input = torch.cat((attended_input, embedded_input), -1)
@@ -420,62 +607,112 @@ class MachampSeq2SeqDecoder(Model):
 
         if self._target_decoder_layers > 1:
             # shape: (1, batch_size, target_embedding_dim)
-            #TODO why is this necessary? 
+            # The pre-embedded teacher forced inputs are slices of a larger tensor, so they might
+            # not be contiguous. The hidden state and context always are.
             decoder_input = decoder_input.unsqueeze(0).contiguous()
-            decoder_context = decoder_context.contiguous()
-            decoder_hidden = decoder_hidden.contiguous()
 
             # shape (decoder_hidden): (num_layers, batch_size, decoder_output_dim)
             # shape (decoder_context): (num_layers, batch_size, decoder_output_dim)
             # TODO (epwalsh): remove the autocast(False) once torch's AMP is working for LSTMCells.
             with torch.cuda.amp.autocast(False):
                 _, (decoder_hidden, decoder_context) = self._decoder_cell(
-                    decoder_input.float(), (decoder_hidden.float(), decoder_context.float())
+                    decoder_input.float(), (decoder_hidden, decoder_context)
                 )
+
+            # shape: (group_size, num_classes)
+            output_projections = self._project_output(decoder_hidden[-1])
         else:
             # shape (decoder_hidden): (batch_size, decoder_output_dim)
             # shape (decoder_context): (batch_size, decoder_output_dim)
             # TODO (epwalsh): remove the autocast(False) once torch's AMP is working for LSTMCells.
             with torch.cuda.amp.autocast(False):
                 decoder_hidden, decoder_context = self._decoder_cell(
-                    decoder_input.float(), (decoder_hidden.float(), decoder_context.float())
+                    decoder_input.float(), (decoder_hidden, decoder_context)
                 )
 
+            # shape: (group_size, num_classes)
+            output_projections = self._project_output(decoder_hidden)
+
         state["decoder_hidden"] = decoder_hidden
         state["decoder_context"] = decoder_context
 
-        # shape: (group_size, num_classes)
-        if self._target_decoder_layers > 1:
-            output_projections = self._output_projection_layer(decoder_hidden[-1])
-        else:
-            output_projections = self._output_projection_layer(decoder_hidden)
         return output_projections, state
 
+    def _project_output(self, decoder_output: torch.Tensor) -> torch.Tensor:
+        """Project decoder outputs of shape (*, decoder_output_dim) to (*, num_classes)."""
+        if self._embedding_projection_layer is not None:
+            decoder_output = self._embedding_projection_layer(decoder_output)
+        return self._output_projection_layer(decoder_output)
+
     def _prepare_attended_input(
         self,
         decoder_hidden_state: torch.LongTensor = None,
         encoder_outputs: torch.LongTensor = None,
         encoder_outputs_mask: torch.BoolTensor = None,
+        encoder_outputs_projected: torch.Tensor = None,
     ) -> torch.Tensor:
-        """Apply attention over encoder outputs and decoder state."""
-        # shape: (batch_size, max_input_sequence_length)
-        input_weights = self._attention(decoder_hidden_state, encoder_outputs, encoder_outputs_mask)
-
-        # shape: (batch_size, encoder_output_dim)
+        """
+        Apply attention over encoder outputs and decoder state. For additive attention,
+        `encoder_outputs_projected` holds the encoder side projection computed in
+        `_init_decoder_state()`, which is reused instead of recomputing it.
+        The encoder outputs can have a smaller batch size than the decoder state: during beam
+        search they are shared by the `group_size / batch_size` beams of each sentence, whose
+        decoder states are attended in a single batched call.
+        """
+        batch_size, _, encoder_output_dim = encoder_outputs.size()
+        # shape: (batch_size, num_beams, decoder_output_dim)
+        decoder_hidden_state = decoder_hidden_state.view(
+            batch_size, -1, decoder_hidden_state.size(-1)
+        )
+        num_beams = decoder_hidden_state.size(1)
+
+        if encoder_outputs_projected is not None:
+            # Mirrors `AdditiveAttention._forward_internal` (allennlp 1.3) and its parent's
+            # normalization, minus the encoder side projection. Check this when upgrading.
+            # shape: (batch_size, num_beams, max_input_sequence_length, decoder_output_dim)
+            intermediate = torch.tanh(
+                decoder_hidden_state.matmul(self._attention._w_matrix).unsqueeze(2)
+                + encoder_outputs_projected.unsqueeze(1)
+            )
+            # shape: (batch_size, num_beams, max_input_sequence_length)
+            input_weights = intermediate.matmul(self._attention._v_vector).squeeze(-1)
+            if self._attention._normalize:
+                input_weights = util.masked_softmax(input_weights, encoder_outputs_mask)
+        elif type(self._attention) is DotProductAttention:
+            # Exact type check: subclasses may compute the scores differently, those go through
+            # the generic branch below.
+            # shape: (batch_size, num_beams, max_input_sequence_length)
+            input_weights = decoder_hidden_state.bmm(encoder_outputs.transpose(1, 2))
+            if self._attention._normalize:
+                input_weights = util.masked_softmax(input_weights, encoder_outputs_mask)
+        else:
+            # Other attention modules only take one vector per encoder output matrix, so the
+            # encoder outputs have to be repeated for every beam.
+            if num_beams > 1:
+                encoder_outputs_repeated = encoder_outputs.repeat_interleave(num_beams, 0)
+                encoder_outputs_mask = encoder_outputs_mask.repeat_interleave(num_beams, 0)
+            else:
+                encoder_outputs_repeated = encoder_outputs
+            # shape: (batch_size, num_beams, max_input_sequence_length)
+            input_weights = self._attention(
+                decoder_hidden_state.view(batch_size * num_beams, -1),
+                encoder_outputs_repeated,
+                encoder_outputs_mask,
+            ).view(batch_size, num_beams, -1)
+
+        # shape: (batch_size, num_beams, encoder_output_dim)
         attended_input = util.weighted_sum(encoder_outputs, input_weights)
 
-        return attended_input
+        # shape: (group_size, encoder_output_dim)
+        return attended_input.view(-1, encoder_output_dim)
 
-    @staticmethod
-    def _get_loss(
-        logits: torch.LongTensor, targets: torch.LongTensor, target_mask: torch.BoolTensor,
-    ) -> torch.Tensor:
+    def _get_loss(self, logits: torch.LongTensor, targets: torch.LongTensor) -> torch.Tensor:
         """
         Compute loss.
         Takes logits (unnormalized outputs from the decoder) of size (batch_size,
-        num_decoding_steps, num_classes), target indices of size (batch_size, num_decoding_steps+1)
-        and corresponding masks of size (batch_size, num_decoding_steps+1) steps and computes cross
-        entropy loss while taking the mask into account.
+        num_decoding_steps, num_classes) and target indices of size (batch_size,
+        num_decoding_steps+1) and computes the cross entropy loss averaged over all non-padding
+        target tokens.
         The length of `targets` is expected to be greater than that of `logits` because the
         decoder does not need to compute the output corresponding to the last timestep of
         `targets`. This method aligns the inputs appropriately to compute the loss.
@@ -484,28 +721,28 @@ class MachampSeq2SeqDecoder(Model):
         appropriate comparison.  Consider a single example where the target has 3 words, and
         padding is to 7 tokens.
            The complete sequence would correspond to <S> w1  w2  w3  <E> <P> <P>
-           and the mask would be                     1   1   1   1   1   0   0
            and let the logits be                     l1  l2  l3  l4  l5  l6
         We actually need to compare:
            the sequence           w1  w2  w3  <E> <P> <P>
-           with masks             1   1   1   1   0   0
            against                l1  l2  l3  l4  l5  l6
            (where the input was)  <S> w1  w2  w3  <E> <P>
+        where the padding positions are ignored.
         """
-        # shape: (batch_size, num_decoding_steps)
-        relevant_targets = targets[:, 1:].contiguous()
-
-        # shape: (batch_size, num_decoding_steps)
-        relevant_mask = target_mask[:, 1:].contiguous()
+        # shape: (batch_size * num_decoding_steps,)
+        relevant_targets = targets[:, 1:].reshape(-1)
 
-        return util.sequence_cross_entropy_with_logits(logits, relevant_targets, relevant_mask)
+        return F.cross_entropy(
+            logits.reshape(-1, logits.size(-1)), relevant_targets, ignore_index=self._pad_index
+        )
 
     @overrides
     def get_metrics(self, reset: bool = False) -> Dict[str, float]:
         main_metrics: Dict[str, float] = {}
-        if self._bleu:# and not self.training:
+        if self._bleu and self._metrics_updated:# and not self.training:
             main_metrics = {
                 f".run/{self.task}/{metric_name}": metric.get_metric(reset)
                 for metric_name, metric in self.metrics.items()
             }
+            if reset:
+                self._metrics_updated = False
         return {**main_metrics}